@@ -0,0 +1,226 @@
+"""
+Shared Gracenote sslgrid client used by gracenote.py and gracenote_to_xmltv.py.
+
+Both scripts send identical requests for the same channel and window, so
+responses cached on disk by one are reused by the other.
+"""
+
+import sys
+import asyncio
+import functools
+import hashlib
+import time
+from dataclasses import dataclass
+from datetime import date, datetime
+from operator import itemgetter
+from typing import Dict, Optional, Tuple
+from xml.sax.saxutils import escape
+import aiohttp
+import diskcache
+import orjson
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+API_URL = "https://tvlistings.gracenote.com/api/sslgrid"
+
+HEADERS = {
+    "Accept": "application/json",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
+    "Content-Type": "application/json"
+}
+
+# Request fields that are the same for every channel
+PAYLOAD_TEMPLATE = {
+    "IsSSLinkNavigation": True,
+    "userId": "-",
+    "aid": "orbebb",
+    "DSTUTCOffset": -240,
+    "STDUTCOffset": -300,
+    "DSTStart": "2026-03-08T02:00Z",
+    "DSTEnd": "2026-11-01T02:00Z",
+    "languagecode": "en-us"
+}
+
+# Days of listings fetched, starting today. Both scripts use this so their requests,
+# and therefore their cache keys, stay identical
+GUIDE_DAYS = 3
+
+# Responses are reused across reruns, and across both scripts, for up to an hour
+CACHE_DIR = ".gracenote_cache"
+CACHE_TTL = 3600
+
+@dataclass(slots=True)
+class Channel:
+    """A Gracenote channel with its lineup fields already split out."""
+    name: str
+    lang: Optional[str]
+    xmltv_id: Optional[str]
+    site_id: Optional[str]
+    device: str = ''
+    lineup_id: str = ''
+    headend_id: str = ''
+    country: str = ''
+    postal: str = ''
+    prgsvcid: str = ''
+
+_fromtimestamp = datetime.fromtimestamp
+
+def fmt_ts(ts: int) -> str:
+    """Format a Unix timestamp as YYYYmmddHHMMSS without going through strftime."""
+    dt = _fromtimestamp(ts)
+    return f"{dt.year:04d}{dt.month:02d}{dt.day:02d}{dt.hour:02d}{dt.minute:02d}{dt.second:02d}"
+
+# Grid slots repeat across channels and days, so most lookups are cache hits
+@functools.lru_cache(maxsize=131072)
+def ts_to_xmltv(ts: int) -> str:
+    """Format a Unix timestamp as an XMLTV date string."""
+    return fmt_ts(ts)
+
+get_times = itemgetter("startTime", "endTime")
+
+XMLTV_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<tv source-info-name="Gracenote TV Listings" source-info-url="https://tvlistings.gracenote.com" '
+    'generator-info-name="Gracenote TV Converter">\n'
+)
+
+def escape_attr(value: str) -> str:
+    """Escape a value for use inside a double-quoted XML attribute."""
+    return escape(value, {'"': "&quot;"})
+
+def programme_attrs(channel: Channel) -> Tuple[str, str]:
+    """Return a channel's escaped id and the lang attribute shared by all its programmes."""
+    channel_id = channel.xmltv_id or channel.site_id
+    lang_attr = f' lang="{escape_attr(channel.lang)}"' if channel.lang else ''
+    return escape_attr(channel_id), lang_attr
+
+class HostRateLimiter:
+    """Limit concurrent requests to one host and honour its rate-limit headers."""
+    
+    def __init__(self, max_concurrency: int = 64):
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self.next_allowed_ts = 0.0
+    
+    async def __aenter__(self):
+        await self._sem.acquire()
+        delay = self.next_allowed_ts - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self._sem.release()
+    
+    def update(self, headers) -> None:
+        """Push back the next request slot if the server asked us to slow down."""
+        delay = None
+        retry_after = headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        elif headers.get('X-RateLimit-Remaining') == '0':
+            reset = headers.get('X-RateLimit-Reset')
+            if reset and reset.isdigit():
+                delay = float(reset)
+                # Some servers send an epoch timestamp rather than a delta
+                if delay > 1e9:
+                    delay -= time.time()
+        if delay and delay > 0:
+            self.next_allowed_ts = max(self.next_allowed_ts, time.monotonic() + delay)
+
+def is_retryable(exc: BaseException) -> bool:
+    """Retry on network errors, timeouts, 429 and 5xx responses."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+def open_session() -> aiohttp.ClientSession:
+    """Create the pooled keep-alive session all Gracenote requests go through."""
+    connector = aiohttp.TCPConnector(limit=256, limit_per_host=64, keepalive_timeout=30)
+    return aiohttp.ClientSession(connector=connector, headers=HEADERS)
+
+def window_start(day: date) -> int:
+    """Return the Unix timestamp of 04:00 local time on day, where Gracenote grids begin."""
+    return int(datetime(day.year, day.month, day.day, 4).timestamp())
+
+def channel_payload(channel: Channel, timestamp: int, timespan: int) -> Dict:
+    """Build the request payload for a channel's listings window."""
+    return {
+        **PAYLOAD_TEMPLATE,
+        "lineupId": channel.lineup_id,
+        "timespan": timespan,
+        "timestamp": timestamp,
+        "prgsvcid": channel.prgsvcid,
+        "headendId": channel.headend_id,
+        "countryCode": channel.country,
+        "postalCode": channel.postal,
+        "device": channel.device
+    }
+
+def cache_key(payload: Dict) -> str:
+    """Key a request by its full payload, so any change in parameters misses the cache."""
+    return hashlib.sha1(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+async def download(channel: Channel, payload: Dict, *, session: aiohttp.ClientSession,
+                   limiter: HostRateLimiter) -> Optional[bytes]:
+    """POST payload with retries and return the response body, or None if every attempt failed."""
+    try:
+        async for attempt in AsyncRetrying(
+            wait=wait_exponential_jitter(initial=1, max=30),
+            stop=stop_after_attempt(5),
+            retry=retry_if_exception(is_retryable),
+            reraise=True
+        ):
+            with attempt:
+                async with limiter, session.post(
+                    API_URL,
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(total=30)
+                ) as response:
+                    limiter.update(response.headers)
+                    response.raise_for_status()
+                    return await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error fetching programs for channel {channel.name}: {e}", file=sys.stderr)
+        return None
+
+def decode(channel: Channel, body: bytes) -> Optional[Dict]:
+    """Decode a response body, or return None if it is not valid JSON."""
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        print(f"Error decoding programs for channel {channel.name}: {e}", file=sys.stderr)
+        return None
+
+async def fetch_raw(channel: Channel, timestamp: int, timespan: int, *, session: aiohttp.ClientSession,
+                    limiter: HostRateLimiter, cache: Optional[diskcache.Cache]) -> Tuple[Optional[bytes], Optional[str]]:
+    """Fetch timespan hours of listings for a channel starting at timestamp.
+    
+    Returns the undecoded response body, or None if the request failed after retries,
+    along with the cache key to store a freshly downloaded body under once it has
+    decoded (see store). The key is None for a body read from the cache.
+    """
+    payload = channel_payload(channel, timestamp, timespan)
+    
+    key = cache_key(payload)
+    if cache is not None:
+        body = cache.get(key)
+        if body is not None:
+            return body, None
+    
+    return await download(channel, payload, session=session, limiter=limiter), key
+
+def store(cache: Optional[diskcache.Cache], key: Optional[str], body: bytes) -> None:
+    """Cache a downloaded body that decoded successfully."""
+    if cache is not None and key is not None:
+        cache.set(key, body, expire=CACHE_TTL)
+
+async def fetch(channel: Channel, timestamp: int, timespan: int, *, session: aiohttp.ClientSession,
+                limiter: HostRateLimiter, cache: Optional[diskcache.Cache]) -> Optional[Dict]:
+    """Fetch and decode a channel's listings, or return None if that failed."""
+    body, key = await fetch_raw(channel, timestamp, timespan, session=session, limiter=limiter, cache=cache)
+    if body is None:
+        return None
+    
+    program_data = decode(channel, body)
+    if program_data is not None:
+        store(cache, key, body)
+    return program_data
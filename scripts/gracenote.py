@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
-import json
 import sys
 import os
 import argparse
-from datetime import datetime, timedelta
-import requests
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from typing import Dict, List, Optional, Any
+import asyncio
+import itertools
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+import aiohttp
+import diskcache
+import ijson
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Any
+from _gracenote_api import (
+    CACHE_DIR, GUIDE_DAYS, XMLTV_HEADER, Channel, HostRateLimiter,
+    escape_attr, fetch, get_times, open_session, programme_attrs, ts_to_xmltv, window_start
+)
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -31,170 +37,243 @@ Examples:
         default='gracenote.xml',
         help='Output XML file (default: gracenote.xml)'
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=f'Always fetch from Gracenote instead of reusing responses cached in {CACHE_DIR}'
+    )
     return parser.parse_args()
 
-def prettify_xml(elem):
-    """Return a pretty-printed XML string for the Element."""
-    rough_string = ET.tostring(elem, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    return reparsed.toprettyxml(indent="  ")
+def build_channel(record: Dict) -> Channel:
+    """Build a Channel from a channels.json record, whose site_id is the prgsvcid."""
+    return Channel(
+        name=record.get("name", "Unknown"),
+        lang=record.get("language"),
+        xmltv_id=record.get("xmltv_id"),
+        site_id=record.get("site_id"),
+        device=record.get("device", ""),
+        lineup_id=record.get("lineup_id", ""),
+        headend_id=record.get("headend_id", ""),
+        country=record.get("country", ""),
+        postal=record.get("postal", ""),
+        prgsvcid=record.get("site_id", "")
+    )
 
-def fetch_program_data(channel_data: Dict, date_str: str) -> Optional[Dict]:
-    """Fetch program data from Gracenote API for a specific date."""
-    timestamp = int(datetime.strptime(f'{date_str} 04:00:00', '%Y-%m-%d %H:%M:%S').timestamp())
-    
-    payload = {
-        "lineupId": channel_data.get("lineup_id"),
-        "IsSSLinkNavigation": True,
-        "timespan": 336,
-        "timestamp": timestamp,
-        "prgsvcid": channel_data.get("site_id"),
-        "headendId": channel_data.get("headend_id"),
-        "countryCode": channel_data.get("country"),
-        "postalCode": channel_data.get("postal"),
-        "device": channel_data.get("device"),
-        "userId": "-",
-        "aid": "orbebb",
-        "DSTUTCOffset": -240,
-        "STDUTCOffset": -300,
-        "DSTStart": "2026-03-08T02:00Z",
-        "DSTEnd": "2026-11-01T02:00Z",
-        "languagecode": "en-us"
-    }
-    
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
-        "Content-Type": "application/json"
-    }
-    
-    try:
-        response = requests.post(
-            "https://tvlistings.gracenote.com/api/sslgrid",
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        print(f"Error fetching data for channel {channel_data.get('name')}: {e}")
-        return None
+def read_channels(f) -> Iterator[Channel]:
+    """Stream channels out of channels.json, skipping any without an id."""
+    for record in ijson.items(f, 'item'):
+        channel = build_channel(record)
+        if channel.xmltv_id or channel.site_id:
+            yield channel
+        else:
+            # Without an id there is nothing to request or to reference from <programme>
+            print(f"Skipping channel without xmltv_id or site_id: {channel.name}")
 
-def process_channel(channel_data: Dict, dates: List[str]) -> List[Dict]:
-    """Process a single channel and return list of programs."""
-    all_programs = []
+def process_channel(program_data: Optional[Dict], program_cache: Dict[Any, Dict]) -> List[Tuple]:
+    """Process a single channel's data for every returned date and return its airings.
     
-    for date_str in dates:
-        print(f"Fetching data for {channel_data.get('name')} on {date_str}...")
+    Each airing is a (start, end, program_id, rating) tuple. Program
+    metadata is shared across airings and channels through program_cache, keyed
+    by program_id.
+    """
+    airings = []
+    
+    if not program_data:
+        return airings
         
-        program_data = fetch_program_data(channel_data, date_str)
-        if not program_data:
-            continue
+    append = airings.append
+    
+    # The request window only covers the wanted dates, so every returned date is used
+    for program in itertools.chain.from_iterable(program_data.values()):
+        try:
+            # Convert Unix timestamps to XMLTV format; a missing time lands in the except below
+            start_ts, end_ts = get_times(program)
+            start_str = ts_to_xmltv(start_ts)
+            end_str = ts_to_xmltv(end_ts)
             
-        # Extract programs for the specific date
-        date_programs = program_data.get(date_str, [])
-        
-        for program in date_programs:
             try:
-                # Convert Unix timestamps to XMLTV format
-                start_time = datetime.fromtimestamp(program.get("startTime"))
-                end_time = datetime.fromtimestamp(program.get("endTime"))
-                
-                start_str = start_time.strftime("%Y%m%d%H%M%S")
-                end_str = end_time.strftime("%Y%m%d%H%M%S")
-                
-                prog_info = program.get("program", {})
-                
-                # Extract season/episode information
-                season = prog_info.get("season")
-                episode = prog_info.get("episode")
-                
-                program_entry = {
-                    "start": start_str,
-                    "end": end_str,
-                    "channel_id": channel_data.get("xmltv_id") or channel_data.get("site_id"),
+                prog_info = program["program"]
+            except KeyError:
+                prog_info = {}
+            
+            # The same program airs many times across channels and days
+            program_id = prog_info.get("tmsId") or (
+                prog_info.get("title"), prog_info.get("episodeTitle"), prog_info.get("shortDesc"),
+                prog_info.get("season"), prog_info.get("episode")
+            )
+            if program_id not in program_cache:
+                program_cache[program_id] = {
                     "title": prog_info.get("title", "Unknown"),
                     "episode_title": prog_info.get("episodeTitle"),
                     "description": prog_info.get("shortDesc"),
-                    "season": season if season is not None else None,
-                    "episode": episode if episode is not None else None,
-                    "rating": program.get("rating"),
-                    "language": channel_data.get("language")
+                    "season": prog_info.get("season"),
+                    "episode": prog_info.get("episode")
                 }
-                
-                all_programs.append(program_entry)
-            except Exception as e:
-                print(f"Error processing program: {e}")
-                continue
+            
+            append((start_str, end_str, program_id, program.get("rating")))
+        except Exception as e:
+            print(f"Error processing program: {e}")
+            continue
     
-    return all_programs
+    return airings
 
-def create_xmltv(channels: List[Dict], programs: List[Dict]) -> str:
-    """Create XMLTV document from channels and programs."""
-    # Create root element
-    tv = ET.Element("tv")
-    tv.set("source-info-name", "Gracenote TV Listings")
-    tv.set("source-info-url", "https://tvlistings.gracenote.com")
-    tv.set("generator-info-name", "Gracenote TV Converter")
-    
-    # Add channel definitions
-    for channel in channels:
-        channel_id = channel.get("xmltv_id") or channel.get("site_id")
-        channel_elem = ET.SubElement(tv, "channel")
-        channel_elem.set("id", str(channel_id))
-        
-        display_name = ET.SubElement(channel_elem, "display-name")
-        display_name.text = channel.get("name", "Unknown")
-    
-    # Add programs
-    for program in programs:
-        programme = ET.SubElement(tv, "programme")
-        programme.set("start", f"{program['start']} +0000")
-        programme.set("stop", f"{program['end']} +0000")
-        programme.set("channel", str(program['channel_id']))
-        
-        # Add title
-        title = ET.SubElement(programme, "title")
-        if program['language']:
-            title.set("lang", program['language'])
-        title.text = program['title']
-        
-        # Add sub-title (episode title) if exists
-        if program['episode_title']:
-            subtitle = ET.SubElement(programme, "sub-title")
-            if program['language']:
-                subtitle.set("lang", program['language'])
-            subtitle.text = program['episode_title']
-        
-        # Add description if exists
-        if program['description']:
-            desc = ET.SubElement(programme, "desc")
-            if program['language']:
-                desc.set("lang", program['language'])
-            desc.text = program['description']
-        
-        # Add episode numbers if available
-        if program['season'] is not None and program['episode'] is not None:
-            # xmltv_ns format
-            ep_ns = ET.SubElement(programme, "episode-num")
-            ep_ns.set("system", "xmltv_ns")
-            ep_ns.text = f"{program['season']}.{program['episode']}.0"
-            
-            # onscreen format
-            ep_onscreen = ET.SubElement(programme, "episode-num")
-            ep_onscreen.set("system", "onscreen")
-            ep_onscreen.text = f"S{program['season']}E{program['episode']}"
+def make_channel(channel: Channel) -> str:
+    """Render the <channel> element for a channel definition."""
+    channel_id = channel.xmltv_id or channel.site_id
+    return (
+        f'  <channel id="{escape_attr(str(channel_id))}">\n'
+        f'    <display-name>{escape(channel.name)}</display-name>\n'
+        f'  </channel>\n'
+    )
+
+def make_programme(airing: Tuple, program: Dict, channel_attr: str, lang_attr: str) -> str:
+    """Render the <programme> element for one airing of a program."""
+    start, end, _, rating = airing
+    
+    parts = [
+        f'  <programme start="{start} +0000" stop="{end} +0000" channel="{channel_attr}">\n',
+        f'    <title{lang_attr}>{escape(program["title"] or "")}</title>\n'
+    ]
+    
+    # Add sub-title (episode title) if exists
+    if program['episode_title']:
+        parts.append(f'    <sub-title{lang_attr}>{escape(program["episode_title"])}</sub-title>\n')
+    
+    # Add description if exists
+    if program['description']:
+        parts.append(f'    <desc{lang_attr}>{escape(program["description"])}</desc>\n')
+    
+    # Add episode numbers if available (xmltv_ns and onscreen formats)
+    if program['season'] is not None and program['episode'] is not None:
+        season = escape(str(program['season']))
+        episode = escape(str(program['episode']))
+        parts.append(
+            f'    <episode-num system="xmltv_ns">{season}.{episode}.0</episode-num>\n'
+            f'    <episode-num system="onscreen">S{season}E{episode}</episode-num>\n'
+        )
+    
+    # Add rating if available
+    if rating:
+        parts.append(f'    <rating>\n      <value>{escape(rating)}</value>\n    </rating>\n')
+    
+    parts.append('  </programme>\n')
+    return ''.join(parts)
+
+# Responses fetched but not yet written; fetches wait for a free slot
+MAX_PENDING = 32
+
+async def produce(session: aiohttp.ClientSession, limiter: HostRateLimiter, slots: asyncio.Semaphore,
+                  queue: asyncio.Queue, channel: Channel, timestamp: int, timespan: int,
+                  cache: Optional[diskcache.Cache]) -> None:
+    """Fetch one channel and hand the response to the writer.
+    
+    A slot is taken before fetching and released by the writer once the response
+    is written, so at most as many responses as there are slots exist at once.
+    """
+    await slots.acquire()
+    print(f"Fetching data for {channel.name}...")
+    
+    try:
+        program_data = await fetch(channel, timestamp, timespan, session=session, limiter=limiter, cache=cache)
+    except Exception as e:
+        print(f"Error fetching data for channel {channel.name}: {e}")
+        program_data = None
+    
+    if program_data:
+        await queue.put((channel, program_data))
+    else:
+        slots.release()
+
+async def consume(out, queue: asyncio.Queue, slots: asyncio.Semaphore) -> int:
+    """Write programmes from queued responses until the None sentinel arrives.
+    
+    Each written response frees its producer's slot.
+    """
+    count = 0
+    program_cache: Dict[Any, Dict] = {}
+    
+    while True:
+        item = await queue.get()
+        if item is None:
+            return count
         
-        # Add rating if available
-        if program['rating']:
-            rating_elem = ET.SubElement(programme, "rating")
-            value_elem = ET.SubElement(rating_elem, "value")
-            value_elem.text = program['rating']
+        # The channel id and language are the same for every programme on a channel
+        channel, program_data = item
+        try:
+            channel_attr, lang_attr = programme_attrs(channel)
+            for airing in process_channel(program_data, program_cache):
+                try:
+                    out.write(make_programme(airing, program_cache[airing[2]], channel_attr, lang_attr))
+                    count += 1
+                except Exception as e:
+                    print(f"Error writing program: {e}")
+        finally:
+            # Drop the response before freeing its slot, so the bound holds while waiting
+            item = program_data = None
+            slots.release()
+
+async def write_xmltv(output_file: str, channels: Iterable[Channel], start_day: date, days: int,
+                      cache: Optional[diskcache.Cache]) -> Tuple[int, int]:
+    """Fetch days of listings for every channel and stream the XMLTV document to output_file.
     
-    return prettify_xml(tv)
+    Each channel's request is scheduled as soon as the channel is read. Responses are
+    queued to a single writer as they arrive, and a fetch only starts once one of
+    MAX_PENDING slots is free, so at most MAX_PENDING responses are held in memory.
+    Returns the number of channels and programmes written.
+    """
+    limiter = HostRateLimiter(64)
+    slots = asyncio.Semaphore(MAX_PENDING)
+    queue = asyncio.Queue(maxsize=MAX_PENDING)
+    
+    # One request per channel covering exactly the requested days
+    timestamp = window_start(start_day)
+    timespan = days * 24
+    
+    # Stream into a temporary file next to the output and only move it into place once
+    # the whole document is written, so a failed run leaves the previous guide intact
+    tmp_file = f"{output_file}.tmp"
+    tasks = []
+    try:
+        async with open_session() as session:
+            with open(tmp_file, 'w', encoding='utf-8') as out:
+                out.write(XMLTV_HEADER)
+                
+                # Add channel definitions, starting each channel's fetch as it is read.
+                # The writer is only started afterwards, so every <channel> precedes the programmes.
+                for channel in channels:
+                    out.write(make_channel(channel))
+                    tasks.append(asyncio.create_task(
+                        produce(session, limiter, slots, queue, channel, timestamp, timespan, cache)
+                    ))
+                    await asyncio.sleep(0)
+                
+                # Add programs as their responses arrive
+                consumer = asyncio.create_task(consume(out, queue, slots))
+                producers = asyncio.gather(*tasks)
+                
+                await asyncio.wait({consumer, producers}, return_when=asyncio.FIRST_COMPLETED)
+                if consumer.done():
+                    # The writer failed, so nothing is draining the queue any more
+                    producers.cancel()
+                    consumer.result()
+                
+                await queue.put(None)
+                program_count = await consumer
+                
+                out.write('</tv>\n')
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+    
+    return len(tasks), program_count
 
-def main():
+async def main_async():
     args = parse_arguments()
     
     # Check if input file exists
@@ -203,41 +282,31 @@ def main():
         sys.exit(1)
     
     try:
-        # Load channel data
-        with open(args.input_file, 'r', encoding='utf-8') as f:
-            channels_data = json.load(f)
-        
-        print(f"Loaded {len(channels_data)} channels from {args.input_file}")
-        
-        # Generate dates for next 3 days
+        # Stream channel data and fetch the next GUIDE_DAYS days for all channels concurrently,
+        # writing XMLTV as responses arrive
         today = datetime.now().date()
-        dates = [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(3)]
-        
-        all_programs = []
-        
-        # Process each channel
-        for i, channel in enumerate(channels_data):
-            print(f"Processing channel {i+1}/{len(channels_data)}: {channel.get('name', 'Unknown')}")
-            channel_programs = process_channel(channel, dates)
-            all_programs.extend(channel_programs)
-        
-        print(f"Total programs fetched: {len(all_programs)}")
-        
-        # Create XMLTV output
-        xml_content = create_xmltv(channels_data, all_programs)
-        
-        # Write to output file
-        with open(args.output, 'w', encoding='utf-8') as f:
-            f.write(xml_content)
+        cache = None if args.no_cache else diskcache.Cache(CACHE_DIR)
+        try:
+            with open(args.input_file, 'rb') as f:
+                channels = read_channels(f)
+                channel_count, program_count = await write_xmltv(args.output, channels, today, GUIDE_DAYS, cache)
+        finally:
+            if cache is not None:
+                cache.close()
         
+        print(f"Loaded {channel_count} channels from {args.input_file}")
+        print(f"Total programs fetched: {program_count}")
         print(f"XMLTV file saved to: {args.output}")
         
-    except json.JSONDecodeError as e:
+    except ijson.JSONError as e:
         print(f"Error parsing JSON file: {e}")
         sys.exit(1)
     except Exception as e:
         print(f"Unexpected error: {e}")
         sys.exit(1)
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
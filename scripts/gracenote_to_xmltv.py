@@ -9,12 +9,18 @@ import sys
 import os
 import json
 import argparse
-from datetime import datetime, timedelta
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
-import requests
-from typing import Dict, List, Optional, Any
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from xml.sax.saxutils import escape
+import diskcache
+from lxml import etree
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Any
 import re
+from _gracenote_api import (
+    CACHE_DIR, GUIDE_DAYS, XMLTV_HEADER, Channel, HostRateLimiter,
+    decode, escape_attr, fetch_raw, get_times, open_session, programme_attrs, store, ts_to_xmltv, window_start
+)
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -29,6 +35,8 @@ Examples:
     )
     parser.add_argument('input', nargs='?', help='Input XML file (channels.xml)')
     parser.add_argument('-o', '--output', help='Output XMLTV file')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'Always fetch from Gracenote instead of reusing responses cached in {CACHE_DIR}')
     
     # If no arguments, show help
     if len(sys.argv) == 1:
@@ -37,199 +45,212 @@ Examples:
     
     return parser.parse_args()
 
-def parse_channels_file(xml_file: str) -> List[Dict]:
-    """Parse the channels XML file and extract channel information."""
-    channels = []
+def build_channel(channel_elem) -> Channel:
+    """Extract channel information from a <channel> element."""
+    channel = Channel(
+        name=channel_elem.text.strip() if channel_elem.text else '',
+        lang=channel_elem.get('lang'),
+        xmltv_id=channel_elem.get('xmltv_id'),
+        site_id=channel_elem.get('site_id')
+    )
     
+    if channel.site_id:
+        parts = channel.site_id.split('/')
+        if len(parts) >= 6:
+            (channel.device, channel.lineup_id, channel.headend_id,
+             channel.country, channel.postal, channel.prgsvcid) = parts[:6]
+    
+    return channel
+
+def parse_channels_file(xml_file: str) -> Iterator[Channel]:
+    """Stream channel information out of the channels XML file."""
     try:
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        
         # Assuming structure: <channels><channel>...</channel></channels>
-        for channel_elem in root.findall('.//channel'):
-            channel = {
-                'name': channel_elem.text.strip() if channel_elem.text else '',
-                'lang': channel_elem.get('lang'),
-                'xmltv_id': channel_elem.get('xmltv_id'),
-                'site_id': channel_elem.get('site_id')
-            }
+        for _, channel_elem in etree.iterparse(xml_file, tag='channel'):
+            channel = build_channel(channel_elem)
+            if channel.xmltv_id or channel.site_id:
+                yield channel
+            else:
+                # Without an id there is nothing to request or to reference from <programme>
+                print(f"Skipping channel without xmltv_id or site_id: {channel.name}", file=sys.stderr)
             
-            if channel['site_id']:
-                parts = channel['site_id'].split('/')
-                if len(parts) >= 6:
-                    channel['device'] = parts[0]
-                    channel['lineup_id'] = parts[1]
-                    channel['headend_id'] = parts[2]
-                    channel['country'] = parts[3]
-                    channel['postal'] = parts[4]
-                    channel['prgsvcid'] = parts[5]
-            
-            channels.append(channel)
+            # Drop parsed channels so memory stays flat on large files
+            channel_elem.clear()
+            while channel_elem.getprevious() is not None:
+                del channel_elem.getparent()[0]
     
-    except ET.ParseError as e:
+    except etree.XMLSyntaxError as e:
         print(f"Error parsing XML file: {e}", file=sys.stderr)
         sys.exit(1)
     except Exception as e:
         print(f"Error reading file: {e}", file=sys.stderr)
         sys.exit(1)
-    
-    return channels
 
-def fetch_programs(channel: Dict) -> Optional[Dict]:
-    """Fetch program listings from Gracenote API for a channel."""
-    timestamp = int(datetime.combine(datetime.now().date(), datetime.min.time().replace(hour=4)).timestamp())
-    date_str = datetime.now().strftime('%Y-%m-%d')
+async def fetch_all_programs(channel_source: Iterable[Channel], cache: Optional[diskcache.Cache]) -> Tuple[List[Channel], List[Optional[bytes]], List[Optional[str]]]:
+    """Fetch program data for each channel as soon as it is parsed.
     
-    payload = {
-        "lineupId": channel.get('lineup_id', ''),
-        "IsSSLinkNavigation": True,
-        "timespan": 336,
-        "timestamp": timestamp,
-        "prgsvcid": channel.get('prgsvcid', ''),
-        "headendId": channel.get('headend_id', ''),
-        "countryCode": channel.get('country', ''),
-        "postalCode": channel.get('postal', ''),
-        "device": channel.get('device', ''),
-        "userId": "-",
-        "aid": "orbebb",
-        "DSTUTCOffset": -240,
-        "STDUTCOffset": -300,
-        "DSTStart": "2026-03-08T02:00Z",
-        "DSTEnd": "2026-11-01T02:00Z",
-        "languagecode": "en-us"
-    }
+    Returns the channels in input order along with their undecoded responses and
+    the cache keys to store freshly downloaded responses under once they decode.
+    """
+    limiter = HostRateLimiter(64)
+    channels = []
+    tasks = []
     
-    headers = {
-        "Accept": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
-        "Content-Type": "application/json"
-    }
+    # Every channel's window starts today and covers GUIDE_DAYS
+    timestamp = window_start(datetime.now().date())
+    timespan = GUIDE_DAYS * 24
     
-    try:
-        response = requests.post(
-            "https://tvlistings.gracenote.com/api/sslgrid",
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching programs for channel {channel.get('name')}: {e}", file=sys.stderr)
-        return None
+    async with open_session() as session:
+        for channel in channel_source:
+            channels.append(channel)
+            tasks.append(asyncio.create_task(
+                fetch_raw(channel, timestamp, timespan, session=session, limiter=limiter, cache=cache)
+            ))
+            # Let the request start while the rest of the file is parsed
+            await asyncio.sleep(0)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    
+    bodies = []
+    keys = []
+    for channel, result in zip(channels, results):
+        if isinstance(result, BaseException):
+            print(f"Error fetching programs for channel {channel.name}: {result}", file=sys.stderr)
+            result = None, None
+        bodies.append(result[0])
+        keys.append(result[1])
+    
+    return channels, bodies, keys
 
-def parse_programs(program_data: Dict, channel: Dict) -> List[Dict]:
+def parse_programs(program_data: Dict) -> List[Dict]:
     """Parse program data from Gracenote API response."""
     programs = []
-    today = datetime.now().date()
+    append = programs.append
     
-    # Process 3 days of programs
-    for day_offset in range(3):
-        date_key = (today + timedelta(days=day_offset)).strftime('%Y-%m-%d')
-        
-        if program_data and date_key in program_data:
-            day_programs = program_data[date_key]
-            
-            for program in day_programs:
+    # The request window only covers GUIDE_DAYS, so every returned date is used
+    for day_programs in (program_data or {}).values():
+        for program in day_programs:
+            try:
+                # Parse program information
+                try:
+                    start_ts, end_ts = get_times(program)
+                except KeyError:
+                    start_ts, end_ts = program.get('startTime', 0), program.get('endTime', 0)
+                
                 try:
-                    # Parse program information
-                    start_time = datetime.fromtimestamp(program.get('startTime', 0))
-                    end_time = datetime.fromtimestamp(program.get('endTime', 0))
-                    
-                    program_info = program.get('program', {})
-                    
-                    prog = {
-                        'start': start_time.strftime('%Y%m%d%H%M%S'),
-                        'stop': end_time.strftime('%Y%m%d%H%M%S'),
-                        'channel_id': channel.get('xmltv_id') or channel.get('site_id'),
-                        'title': program_info.get('title', ''),
-                        'short_desc': program_info.get('shortDesc'),
-                        'rating': program.get('rating'),
-                        'season': program_info.get('season'),
-                        'episode': program_info.get('episode'),
-                        'episode_title': program_info.get('episodeTitle'),
-                        'lang': channel.get('lang')
-                    }
-                    programs.append(prog)
-                except (KeyError, TypeError, ValueError) as e:
-                    print(f"Error parsing program: {e}", file=sys.stderr)
-                    continue
+                    program_info = program['program']
+                except KeyError:
+                    program_info = {}
+                
+                prog = {
+                    'start': ts_to_xmltv(start_ts),
+                    'stop': ts_to_xmltv(end_ts),
+                    'title': program_info.get('title', ''),
+                    'short_desc': program_info.get('shortDesc'),
+                    'rating': program.get('rating'),
+                    'season': program_info.get('season'),
+                    'episode': program_info.get('episode'),
+                    'episode_title': program_info.get('episodeTitle')
+                }
+                append(prog)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Error parsing program: {e}", file=sys.stderr)
+                continue
     
     return programs
 
-def create_xmltv(channels: List[Dict], all_programs: List[List[Dict]]) -> str:
-    """Create XMLTV document from channels and programs."""
-    # Create root element
-    tv = ET.Element('tv')
-    tv.set('source-info-name', 'Gracenote TV Listings')
-    tv.set('source-info-url', 'https://tvlistings.gracenote.com')
-    tv.set('generator-info-name', 'Gracenote TV Converter')
+def format_channel(channel: Channel) -> str:
+    """Render the <channel> element for a channel."""
+    channel_id = channel.xmltv_id or channel.site_id
+    return (
+        f'  <channel id="{escape_attr(channel_id)}">\n'
+        f'    <display-name>{escape(channel.name)}</display-name>\n'
+        f'  </channel>\n'
+    )
+
+def format_programme(program: Dict, channel_attr: str, lang_attr: str) -> str:
+    """Render the <programme> element for a single program."""
+    parts = [
+        f'  <programme start="{program["start"]} +0000" stop="{program["stop"]} +0000" '
+        f'channel="{channel_attr}">\n',
+        f'    <title{lang_attr}>{escape(program["title"] or "")}</title>\n'
+    ]
     
-    # Add channels
-    for channel in channels:
-        channel_id = channel.get('xmltv_id') or channel.get('site_id')
-        if not channel_id:
-            continue
-            
-        channel_elem = ET.SubElement(tv, 'channel')
-        channel_elem.set('id', channel_id)
-        
-        display_name = ET.SubElement(channel_elem, 'display-name')
-        display_name.text = channel.get('name', '')
+    # Episode title (sub-title)
+    if program.get('episode_title'):
+        parts.append(f'    <sub-title{lang_attr}>{escape(program["episode_title"])}</sub-title>\n')
     
-    # Add programs
-    for channel_programs in all_programs:
-        for program in channel_programs:
-            programme = ET.SubElement(tv, 'programme')
-            programme.set('start', f"{program['start']} +0000")
-            programme.set('stop', f"{program['stop']} +0000")
-            programme.set('channel', program['channel_id'])
-            
-            # Title
-            title = ET.SubElement(programme, 'title')
-            if program['lang']:
-                title.set('lang', program['lang'])
-            title.text = program['title']
-            
-            # Episode title (sub-title)
-            if program.get('episode_title'):
-                sub_title = ET.SubElement(programme, 'sub-title')
-                if program['lang']:
-                    sub_title.set('lang', program['lang'])
-                sub_title.text = program['episode_title']
+    # Description
+    if program.get('short_desc'):
+        parts.append(f'    <desc{lang_attr}>{escape(program["short_desc"])}</desc>\n')
+    
+    # Episode numbers: XMLTV NS format (season.episode.part) and on-screen format
+    if program.get('season') and program.get('episode'):
+        season = escape(str(program['season']))
+        episode = escape(str(program['episode']))
+        parts.append(
+            f'    <episode-num system="xmltv_ns">{season}.{episode}.0</episode-num>\n'
+            f'    <episode-num system="onscreen">S{season}E{episode}</episode-num>\n'
+        )
+    
+    # Rating
+    if program.get('rating'):
+        parts.append(f'    <rating>\n      <value>{escape(program["rating"])}</value>\n    </rating>\n')
+    
+    parts.append('  </programme>\n')
+    return ''.join(parts)
+
+def render_channel_programmes(job: Tuple[Channel, Optional[bytes]]) -> Tuple[Optional[str], int]:
+    """Decode one channel's response and render all of its <programme> elements.
+    
+    Runs in a worker process. Returns the rendered text and the number of
+    programmes, or (None, 0) if there was nothing to render or the body did not
+    decode.
+    """
+    channel, body = job
+    if not body:
+        return None, 0
+    
+    program_data = decode(channel, body)
+    if program_data is None:
+        return None, 0
+    
+    programs = parse_programs(program_data)
+    # The channel id and language are the same for every programme on a channel
+    channel_attr, lang_attr = programme_attrs(channel)
+    return ''.join(format_programme(program, channel_attr, lang_attr) for program in programs), len(programs)
+
+def write_xmltv(output_file: str, channels: List[Channel], bodies: List[Optional[bytes]],
+                keys: List[Optional[str]], cache: Optional[diskcache.Cache]) -> None:
+    """Write the XMLTV document, caching each downloaded response once it has rendered."""
+    # Channels are decoded and rendered in worker processes, and their programmes
+    # are written in input order as they finish.
+    print("Creating XMLTV document...")
+    try:
+        with open(output_file, 'w', encoding='utf-8') as f, ProcessPoolExecutor() as executor:
+            f.write(XMLTV_HEADER)
             
-            # Description
-            if program.get('short_desc'):
-                desc = ET.SubElement(programme, 'desc')
-                if program['lang']:
-                    desc.set('lang', program['lang'])
-                desc.text = program['short_desc']
+            # Add channels
+            for channel in channels:
+                f.write(format_channel(channel))
             
-            # Episode numbers
-            if program.get('season') and program.get('episode'):
-                # XMLTV NS format (season.episode.part)
-                ep_num_ns = ET.SubElement(programme, 'episode-num')
-                ep_num_ns.set('system', 'xmltv_ns')
-                ep_num_ns.text = f"{program['season']}.{program['episode']}.0"
+            # Add programs
+            rendered = executor.map(render_channel_programmes, zip(channels, bodies), chunksize=4)
+            for i, (channel, (text, count)) in enumerate(zip(channels, rendered)):
+                print(f"Channel {i + 1}/{len(channels)}: {channel.name}")
                 
-                # On-screen format
-                ep_num_onscreen = ET.SubElement(programme, 'episode-num')
-                ep_num_onscreen.set('system', 'onscreen')
-                ep_num_onscreen.text = f"S{program['season']}E{program['episode']}"
+                if text is not None:
+                    f.write(text)
+                    # The worker decoded this body, so it is safe to reuse
+                    store(cache, keys[i], bodies[i])
+                    print(f"  Found {count} programs")
+                else:
+                    print(f"  No programs found or error fetching")
             
-            # Rating
-            if program.get('rating'):
-                rating_elem = ET.SubElement(programme, 'rating')
-                value = ET.SubElement(rating_elem, 'value')
-                value.text = program['rating']
-    
-    # Convert to pretty XML
-    xml_string = ET.tostring(tv, encoding='utf-8')
-    parsed = minidom.parseString(xml_string)
-    pretty_xml = parsed.toprettyxml(indent='  ', encoding='utf-8')
-    
-    # Add XML declaration
-    return pretty_xml
+            f.write('</tv>\n')
+        print(f"Successfully saved XMLTV to {output_file}")
+    except IOError as e:
+        print(f"Error saving file: {e}", file=sys.stderr)
+        sys.exit(1)
 
 def main():
     args = parse_args()
@@ -255,37 +276,16 @@ def main():
     print(f"Processing channels from: {input_file}")
     print(f"Output will be saved to: {output_file}")
     
-    # Parse channels
-    channels = parse_channels_file(input_file)
-    print(f"Found {len(channels)} channels")
-    
-    all_programs = []
-    
-    # Fetch programs for each channel
-    for i, channel in enumerate(channels, 1):
-        print(f"Fetching programs for channel {i}/{len(channels)}: {channel.get('name')}")
-        
-        program_data = fetch_programs(channel)
-        if program_data:
-            programs = parse_programs(program_data, channel)
-            all_programs.append(programs)
-            print(f"  Found {len(programs)} programs")
-        else:
-            print(f"  No programs found or error fetching")
-            all_programs.append([])
-    
-    # Create XMLTV
-    print("Creating XMLTV document...")
-    xmltv_data = create_xmltv(channels, all_programs)
-    
-    # Save to file
+    # Parse channels and fetch their programs concurrently. The cache stays open while
+    # writing, since downloaded responses are only cached once a worker has decoded them.
+    cache = None if args.no_cache else diskcache.Cache(CACHE_DIR)
     try:
-        with open(output_file, 'wb') as f:
-            f.write(xmltv_data)
-        print(f"Successfully saved XMLTV to {output_file}")
-    except IOError as e:
-        print(f"Error saving file: {e}", file=sys.stderr)
-        sys.exit(1)
+        channels, bodies, keys = asyncio.run(fetch_all_programs(parse_channels_file(input_file), cache))
+        print(f"Found {len(channels)} channels")
+        write_xmltv(output_file, channels, bodies, keys, cache)
+    finally:
+        if cache is not None:
+            cache.close()
 
 if __name__ == '__main__':
     main()
@@ -1,219 +1,336 @@
 import json
 import sys
-import xml.etree.ElementTree as ET
+import ssl
+from lxml import etree as ET
 import argparse
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import requests
-from typing import Optional, Dict, List
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, List, Tuple
 import urllib3
-from xml.dom import minidom
+from urllib3.util.retry import Retry
 
 # Disable SSL warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def fetch_epg_data(channel_id: str, max_items: int = 50) -> Optional[ET.Element]:
-    """Fetch EPG data from Fuelmedia API"""
+USER_AGENT = 'FUEL EPG Generator'
+
+# Number of channels fetched concurrently
+MAX_WORKERS = 16
+
+class UnverifiedTLSAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections share one TLS context that skips certificate checks"""
+    
+    def __init__(self, *args, **kwargs):
+        # Without a shared context urllib3 builds a new one for every unverified connection
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        self.ssl_context = context
+        super().__init__(*args, **kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        kwargs['assert_hostname'] = False
+        return super().init_poolmanager(*args, **kwargs)
+
+def create_session(pool_size: int = MAX_WORKERS) -> requests.Session:
+    """Create a keep-alive session for the Fuelmedia API"""
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    session.headers['Accept'] = 'application/rss+xml, application/xml, text/xml'
+    # Ask for every compression urllib3 can decode here (brotli and zstd only when installed)
+    session.headers.update(urllib3.util.make_headers(accept_encoding=True))
+    
+    # Every request goes to the same host, so one pool of reusable connections is enough
+    adapter = UnverifiedTLSAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    return session
+
+def fetch_epg_data(channel_id: str, max_items: int = 50,
+                   session: Optional[requests.Session] = None) -> Optional[Dict]:
+    """Fetch EPG data from Fuelmedia API and parse it as it downloads"""
     url = f"https://fueltools-prod01-v1-fast.fuelmedia.io/mrss?ChId={channel_id}&maxItems={max_items}&ContentType=epg"
     
     try:
-        response = requests.get(url, verify=False, timeout=30)
-        response.raise_for_status()
-        
-        # Check if response contains valid XML
-        if not response.content.strip():
-            print(f"Warning: Empty response for channel {channel_id}")
-            return None
+        with (session or requests).get(url, verify=False, timeout=30, stream=True) as response:
+            response.raise_for_status()
             
-        # Try to parse XML
-        xml_root = ET.fromstring(response.content)
-        return xml_root
-        
+            # Check if response contains anything to parse, without reading the body
+            if response.status_code == 204 or response.headers.get('Content-Length') == '0':
+                print(f"Warning: Empty response for channel {channel_id}")
+                return None
+            
+            # Let urllib3 undo any content encoding before the bytes reach the parser
+            response.raw.decode_content = True
+            epg_data = parse_epg(response.raw)
+            if epg_data is None:
+                print(f"Warning: Empty response for channel {channel_id}")
+            return epg_data
+    
     except ET.ParseError as e:
         print(f"Error parsing XML for channel {channel_id}: {e}")
-        print(f"Response content (first 500 chars): {response.content[:500]}")
         return None
     except Exception as e:
         print(f"Error fetching data for channel {channel_id}: {e}")
         return None
 
-def parse_channel_data(xml_root: ET.Element) -> Dict:
-    """Extract channel information from XML"""
-    channel_data = {'display_name': ''}
+@dataclass(slots=True)
+class Program:
+    """A single programme parsed from a channel's EPG"""
+    start: str
+    stop: str
+    title: str
+    desc: str
+
+def child_elements(elem: ET.Element) -> Dict:
+    """Map each child tag to the first child with that tag, in one pass over the children"""
+    # Built back to front so the first child wins, matching find()
+    return {child.tag: child for child in reversed(elem)}
+
+def text_of(elem: Optional[ET.Element]) -> str:
+    """Return an element's stripped text, or '' if it is missing or empty"""
+    if elem is not None and elem.text:
+        return elem.text.strip()
+    return ''
+
+def parse_programme(prog: ET.Element) -> Program:
+    """Extract program information from a TV XML <programme> element"""
+    children = child_elements(prog)
     
-    try:
-        # Try different possible locations for channel info
-        # Method 1: Direct channel element
-        channel_elem = xml_root.find('channel')
-        if channel_elem is None:
-            # Method 2: Try RSS format
-            channel_elem = xml_root.find('.//channel')
-        
-        if channel_elem is not None:
-            # Try different display-name locations
-            display_name_elem = channel_elem.find('display-name')
-            if display_name_elem is None:
-                display_name_elem = channel_elem.find('title')  # RSS format
-            
-            if display_name_elem is not None and display_name_elem.text:
-                channel_data['display_name'] = display_name_elem.text.strip()
-    except Exception as e:
-        print(f"Error parsing channel data: {e}")
+    # Extract description
+    desc_elem = children.get('desc')
+    if desc_elem is None:
+        desc_elem = children.get('description')
     
-    return channel_data
+    return Program(
+        start=prog.get('start', ''),
+        stop=prog.get('stop', ''),
+        title=text_of(children.get('title')),
+        desc=text_of(desc_elem)
+    )
 
-def parse_programs(xml_root: ET.Element, language: str) -> List[Dict]:
-    """Extract program information from XML"""
-    programs = []
+def parse_item(item: ET.Element) -> Program:
+    """Extract program information from an RSS <item> element"""
+    children = child_elements(item)
     
+    # Start comes from pubDate (simplified); RSS has no stop time
+    return Program(
+        start=text_of(children.get('pubDate')),
+        stop='',
+        title=text_of(children.get('title')),
+        desc=text_of(children.get('description'))
+    )
+
+# Tag suffixes checked by the program-like fallback, each tested in a single endswith call
+_PROGRAM_LIKE_SUFFIXES = ('program', 'show')
+_TITLE_SUFFIXES = ('title', 'name')
+_DESC_SUFFIXES = ('desc', 'description')
+
+def parse_program_like(elem: ET.Element) -> Program:
+    """Extract program information from any element whose tag ends in program or show"""
+    title = ''
+    desc = ''
+    
+    # Look for title and description in child elements
+    for child in elem.iterchildren(ET.Element):
+        tag = child.tag
+        if tag.endswith(_TITLE_SUFFIXES):
+            if child.text:
+                title = child.text.strip()
+        elif tag.endswith(_DESC_SUFFIXES):
+            if child.text:
+                desc = child.text.strip()
+    
+    return Program(
+        start=elem.get('start', elem.get('begin', '')),
+        stop=elem.get('stop', elem.get('end', '')),
+        title=title,
+        desc=desc
+    )
+
+# Record parsers for the two known formats: TV XML <programme> and RSS <item>
+_RECORD_PARSERS = {
+    'programme': parse_programme,
+    'item': parse_item
+}
+
+class ContentProbe:
+    """File-like wrapper that records whether anything but whitespace was read"""
+    
+    def __init__(self, source):
+        self.source = source
+        self.empty = True
+    
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+        # isspace() tests the chunk in place, where strip() would copy it
+        if self.empty and data and not data.isspace():
+            self.empty = False
+        return data
+
+def parse_epg(source) -> Optional[Dict]:
+    """Extract the channel name and programs from an EPG document in a single streaming pass
+    
+    Returns None if the document is empty or has no elements at all.
+    """
+    channel_names = {}
+    records = {tag: [] for tag in _RECORD_PARSERS}
+    programmes = records['programme']
+    items = records['item']
+    program_likes = []
+    
+    # An empty or whitespace-only body makes iterparse raise rather than yield nothing
+    reader = ContentProbe(source)
+    elem = None
     try:
-        # Try different XML structures
-        
-        # Method 1: TV XML format (programme elements)
-        programme_elements = xml_root.findall('.//programme')
-        if programme_elements:
-            for prog in programme_elements:
-                try:
-                    program_data = {
-                        'start': prog.get('start', ''),
-                        'stop': prog.get('stop', ''),
-                        'title': '',
-                        'desc': ''
-                    }
-                    
-                    # Extract title
-                    title_elem = prog.find('title')
-                    if title_elem is not None and title_elem.text:
-                        program_data['title'] = title_elem.text.strip()
-                    
-                    # Extract description
-                    desc_elem = prog.find('desc')
-                    if desc_elem is None:
-                        desc_elem = prog.find('description')
-                    
-                    if desc_elem is not None and desc_elem.text:
-                        program_data['desc'] = desc_elem.text.strip()
-                    
-                    programs.append(program_data)
-                except Exception as e:
-                    print(f"Error parsing programme element: {e}")
-                    continue
-        
-        # Method 2: RSS format (item elements)
-        if not programs:
-            item_elements = xml_root.findall('.//item')
-            for item in item_elements:
-                try:
-                    program_data = {
-                        'start': '',
-                        'stop': '',
-                        'title': '',
-                        'desc': ''
-                    }
-                    
-                    # Extract title
-                    title_elem = item.find('title')
-                    if title_elem is not None and title_elem.text:
-                        program_data['title'] = title_elem.text.strip()
-                    
-                    # Extract description
-                    desc_elem = item.find('description')
-                    if desc_elem is not None and desc_elem.text:
-                        program_data['desc'] = desc_elem.text.strip()
-                    
-                    # Try to get start/stop from pubDate or other elements
-                    pubdate_elem = item.find('pubDate')
-                    if pubdate_elem is not None and pubdate_elem.text:
-                        # Convert pubDate to start time (simplified)
-                        program_data['start'] = pubdate_elem.text.strip()
-                    
-                    programs.append(program_data)
-                except Exception as e:
-                    print(f"Error parsing item element: {e}")
-                    continue
-        
-        # Method 3: Look for any program-like structures
-        if not programs:
-            # Try to find any elements that might contain program data
-            for elem in xml_root.iter():
-                if elem.tag.endswith('program') or elem.tag.endswith('show'):
-                    try:
-                        program_data = {
-                            'start': elem.get('start', elem.get('begin', '')),
-                            'stop': elem.get('stop', elem.get('end', '')),
-                            'title': '',
-                            'desc': ''
-                        }
-                        
-                        # Look for title and description in child elements
-                        for child in elem:
-                            if child.tag.endswith('title') or child.tag.endswith('name'):
-                                if child.text:
-                                    program_data['title'] = child.text.strip()
-                            elif child.tag.endswith('desc') or child.tag.endswith('description'):
-                                if child.text:
-                                    program_data['desc'] = child.text.strip()
-                        
-                        if program_data['title']:  # Only add if we have a title
-                            programs.append(program_data)
-                    except:
-                        continue
+        for _, elem in ET.iterparse(reader, events=('end',), recover=True, remove_blank_text=True):
+            tag = elem.tag
+            record_parser = _RECORD_PARSERS.get(tag)
+            
+            # Known records are done with once read, so free them and their earlier siblings
+            if record_parser is not None:
+                program_data = record_parser(elem)
+                if program_data.title:  # Only keep programs with a title
+                    records[tag].append(program_data)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            
+            # Channel name: <display-name> (TV XML) or <title> (RSS) directly under <channel>
+            elif tag == 'display-name' or tag == 'title':
+                parent = elem.getparent()
+                if parent is not None and parent.tag == 'channel' and elem.text:
+                    channel_names.setdefault(tag, elem.text.strip())
+            
+            # Any other program-like structure, only used when neither format is present,
+            # so stop looking for them as soon as either has been seen
+            elif not (programmes or items) and tag.endswith(_PROGRAM_LIKE_SUFFIXES):
+                program_data = parse_program_like(elem)
+                if program_data.title:  # Only add if we have a title
+                    program_likes.append(program_data)
+    except ET.XMLSyntaxError:
+        if reader.empty:
+            return None
+        raise
     
-    except Exception as e:
-        print(f"Error parsing programs: {e}")
+    if elem is None:
+        return None
+    
+    # Fuelmedia serves RSS, so this fallback should never be needed; report it so it can be removed
+    if program_likes and not (programmes or items):
+        print(f"Note: no programme or item elements, using {len(program_likes)} program-like element(s)")
     
     # Limit to 2 days worth of programs if needed
     # (You might want to add date filtering logic here)
     
-    return programs
+    return {
+        'display_name': channel_names.get('display-name') or channel_names.get('title', ''),
+        'programs': programmes or items or program_likes
+    }
+
+TV_ATTRIBUTES = {
+    'source-info-name': 'Bitcentral, Inc.',
+    'source-info-url': 'https://bitcentral.com',
+    'generator-info-name': 'FUEL EPG Generator'
+}
 
-def create_xmltv_output(all_channels_data: List[Dict]) -> ET.Element:
-    """Create XMLTV formatted XML from all channel data"""
-    # Create root element
-    tv = ET.Element('tv')
-    tv.set('source-info-name', 'Bitcentral, Inc.')
-    tv.set('source-info-url', 'https://bitcentral.com')
-    tv.set('generator-info-name', 'FUEL EPG Generator')
+def write_channel(xf, channel_id: str, display_name: str, language: str, programs: List[Program]) -> None:
+    """Write a channel and its programs to an open XMLTV file, one element at a time"""
+    Element = ET.Element
+    SubElement = ET.SubElement
+    lang_attrib = {'lang': language}
     
-    # Add all channels and programs
-    for channel_info in all_channels_data:
-        channel_id = channel_info['channel_id']
-        display_name = channel_info['display_name']
-        language = channel_info['language']
-        programs = channel_info['programs']
+    # Add channel element
+    channel = Element('channel', {'id': channel_id})
+    display_name_elem = SubElement(channel, 'display-name')
+    display_name_elem.text = display_name
+    xf.write(channel, pretty_print=True)
+    
+    # Add programs for this channel; parsing already dropped those without a title
+    for program in programs:
+        # Start and stop times are required
+        programme = Element('programme', {
+            'start': program.start or '20000101000000',
+            'stop': program.stop or '20000101010000',
+            'channel': channel_id
+        })
         
-        # Add channel element
-        channel = ET.SubElement(tv, 'channel')
-        channel.set('id', channel_id)
+        # Add title
+        title = SubElement(programme, 'title', lang_attrib)
+        title.text = program.title
         
-        display_name_elem = ET.SubElement(channel, 'display-name')
-        display_name_elem.text = display_name
+        # Add description if available
+        desc_text = program.desc
+        if desc_text:
+            desc = SubElement(programme, 'desc', lang_attrib)
+            desc.text = desc_text
         
-        # Add programs for this channel
-        for program in programs:
-            if program['title']:  # Only add if we have a title
-                programme = ET.SubElement(tv, 'programme')
+        xf.write(programme, pretty_print=True)
+
+def write_xmltv(output_file: str, channels_data: List[Dict], futures: List) -> Tuple[int, int, int]:
+    """Write the XMLTV file, adding each channel as soon as its fetch completes
+    
+    Each slot of futures is cleared once its channel is written, so written channels
+    are not kept alive. Returns the number of channels written, how many of them
+    had EPG data, and the number of programs found.
+    """
+    channel_count = 0
+    processed_count = 0
+    total_programs = 0
+    
+    with ET.xmlfile(output_file, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        xf.write_doctype('<!DOCTYPE tv SYSTEM "xmltv.dtd">')
+        
+        # Create root element
+        with xf.element('tv', TV_ATTRIBUTES):
+            xf.write('\n')
+            
+            # Process each channel
+            for idx, channel_info in enumerate(channels_data, 1):
+                channel_id = channel_info.get('channel_id')
+                language = channel_info.get('language', 'en')
                 
-                # Add start time (required)
-                start_time = program['start'] if program['start'] else '20000101000000'
-                programme.set('start', start_time)
+                if not channel_id:
+                    print(f"Warning [{idx}/{len(channels_data)}]: Skipping entry without channel_id")
+                    continue
                 
-                # Add stop time (required)
-                stop_time = program['stop'] if program['stop'] else '20000101010000'
-                programme.set('stop', stop_time)
+                print(f"[{idx}/{len(channels_data)}] Processing channel: {channel_id} ({language})")
                 
-                programme.set('channel', channel_id)
+                # Wait for this channel's EPG data; the future holds it until its slot is cleared
+                future = futures[idx - 1]
+                futures[idx - 1] = None
+                epg_data = future.result()
+                channel_count += 1
+                if epg_data is None:
+                    print(f"  Failed to fetch data for channel {channel_id}")
+                    # Still write the channel with basic info
+                    write_channel(xf, channel_id, f"Channel {channel_id}", language, [])
+                    xf.flush()
+                    continue
                 
-                # Add title
-                title = ET.SubElement(programme, 'title')
-                title.set('lang', language)
-                title.text = program['title']
+                programs = epg_data['programs']
                 
-                # Add description if available
-                if program['desc']:
-                    desc = ET.SubElement(programme, 'desc')
-                    desc.set('lang', language)
-                    desc.text = program['desc']
+                # Use channel ID as display name if not found
+                display_name = epg_data['display_name']
+                if not display_name:
+                    display_name = f"Channel {channel_id}"
+                
+                write_channel(xf, channel_id, display_name, language, programs)
+                xf.flush()
+                
+                print(f"  Found {len(programs)} program(s)")
+                processed_count += 1
+                total_programs += len(programs)
     
-    return tv
+    return channel_count, processed_count, total_programs
 
 def main():
     # Parse command line arguments
@@ -227,8 +344,8 @@ def main():
     
     # Load channel data
     try:
-        with open(args.input_file, 'r', encoding='utf-8') as f:
-            channels_data = json.load(f)
+        with open(args.input_file, 'rb') as f:
+            channels_data = orjson.loads(f.read())
         
         if not isinstance(channels_data, list):
             print(f"Error: Input file must contain a JSON array. Found {type(channels_data)}")
@@ -244,99 +361,37 @@ def main():
         print(f"Error loading input file: {e}")
         sys.exit(1)
     
-    all_channels_data = []
-    processed_count = 0
-    
     print(f"Processing {len(channels_data)} channel(s)...")
     
-    # Process each channel
-    for idx, channel_info in enumerate(channels_data, 1):
-        channel_id = channel_info.get('channel_id')
-        language = channel_info.get('language', 'en')
-        
-        if not channel_id:
-            print(f"Warning [{idx}/{len(channels_data)}]: Skipping entry without channel_id")
-            continue
-        
-        print(f"[{idx}/{len(channels_data)}] Processing channel: {channel_id} ({language})")
-        
-        # Fetch EPG data
-        xml_root = fetch_epg_data(channel_id)
-        if xml_root is None:
-            print(f"  Failed to fetch data for channel {channel_id}")
-            # Still create an entry with basic info
-            all_channels_data.append({
-                'channel_id': channel_id,
-                'display_name': f"Channel {channel_id}",
-                'language': language,
-                'programs': []
-            })
-            continue
-        
-        # Parse channel and program data
-        channel_data = parse_channel_data(xml_root)
-        programs = parse_programs(xml_root, language)
-        
-        # Use channel ID as display name if not found
-        display_name = channel_data.get('display_name', '')
-        if not display_name:
-            display_name = f"Channel {channel_id}"
-        
-        # Store data for XML generation
-        all_channels_data.append({
-            'channel_id': channel_id,
-            'display_name': display_name,
-            'language': language,
-            'programs': programs
-        })
-        
-        print(f"  Found {len(programs)} program(s)")
-        processed_count += 1
-    
-    # Create combined XMLTV output
-    if all_channels_data:
-        print(f"\nCreating XMLTV file with data from {processed_count} channel(s)...")
-        
-        tv = create_xmltv_output(all_channels_data)
-        
-        # Add XML declaration and DOCTYPE
-        xml_declaration = '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n'
-        
-        # Convert to string and pretty print
-        xml_str = ET.tostring(tv, encoding='utf-8').decode('utf-8')
-        
-        # Use minidom for pretty printing
-        try:
-            parsed_xml = minidom.parseString(xml_str)
-            pretty_xml = parsed_xml.toprettyxml(indent="  ")
-            
-            # Remove the default XML declaration from minidom
-            lines = pretty_xml.split('\n')
-            if lines and lines[0].startswith('<?xml'):
-                lines = lines[1:]
-            pretty_xml = xml_declaration + '\n'.join(lines)
-        except:
-            # Fallback if minidom fails
-            print("Warning: Could not pretty print XML, using basic formatting")
-            pretty_xml = xml_declaration + xml_str
-        
-        # Write to file
-        try:
-            with open(args.output, 'w', encoding='utf-8') as f:
-                f.write(pretty_xml)
-            
-            print(f"Success! EPG data saved to {args.output}")
-            print(f"Total channels: {len(all_channels_data)}")
+    # Reuse connections to the API across channels
+    session = create_session()
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Start every fetch up front; responses are handled in input order
+            futures = [
+                executor.submit(fetch_epg_data, channel_info['channel_id'], 50, session)
+                if channel_info.get('channel_id') else None
+                for channel_info in channels_data
+            ]
             
-            # Count total programs
-            total_programs = sum(len(ch['programs']) for ch in all_channels_data)
-            print(f"Total programs: {total_programs}")
+            if not any(futures):
+                print("No EPG data was fetched. Output file not created.")
+                return
             
-        except Exception as e:
-            print(f"Error writing to output file {args.output}: {e}")
-            sys.exit(1)
-    else:
-        print("No EPG data was fetched. Output file not created.")
+            # Write the XMLTV output as each channel's data arrives, so no channel is kept after it is written
+            print(f"Writing XMLTV file to {args.output}...")
+            try:
+                channel_count, processed_count, total_programs = write_xmltv(args.output, channels_data, futures)
+            except Exception as e:
+                print(f"Error writing to output file {args.output}: {e}")
+                sys.exit(1)
+    finally:
+        session.close()
+    
+    print(f"\nSuccess! EPG data saved to {args.output}")
+    print(f"Channels with data: {processed_count}")
+    print(f"Total channels: {channel_count}")
+    print(f"Total programs: {total_programs}")
 
 if __name__ == "__main__":
     main()